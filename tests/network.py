@@ -120,15 +120,17 @@ class VirtualNode:
             # Namespace doesn't exist. Return silently.
             pass
 
-    def run(self, command, user=os.getenv("USER")):
+    def run(self, command, user=os.getenv("USER"),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE):
         """
         Executes a command under the given user from this virtual node. Returns
         an NSOpen object to control the process. NSOpen has the same API as
-        subprocess.POpen.
+        subprocess.POpen. The stdout and stderr arguments are given to POpen,
+        by default the output is available through pipes.
         """
         sudo_command = ['sudo', '-E', '-u', user, 'env', 'PATH=' + os.getenv("PATH")] + command
         return NSPopen(self.namespace, sudo_command, stdin=subprocess.PIPE,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       stdout=stdout, stderr=stderr,
                        universal_newlines=True, start_new_session=True)
 
     def _add_namespace(self, name, address, netmaskLength):
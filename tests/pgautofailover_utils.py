@@ -1,16 +1,46 @@
+import concurrent.futures
+import configparser
+import contextlib
+import functools
 import os
 import os.path
+import select
 import signal
 import shutil
 import time
 import network
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import subprocess
+import threading
 from enum import Enum
+from pathlib import Path
 
 COMMAND_TIMEOUT = 60
 STATE_CHANGE_TIMEOUT = 90
 
+# the monitor notifies node state changes on this channel, see
+# src/monitor/notifications.h
+STATE_CHANNEL = "state"
+
+# number of connections the test process keeps open to the monitor for its
+# queries, concurrent callers wait for a free one
+MONITOR_POOL_SIZE = 4
+
+# environment for the commands we run, set once for all the clusters of this
+# process so that a new Cluster doesn't change it under running commands
+os.environ["PG_REGRESS_SOCK_DIR"] = ''
+os.environ["PG_AUTOCTL_DEBUG"] = ''
+os.environ["PGHOST"] = 'localhost'
+
+@functools.lru_cache(maxsize=None)
+def _which(command):
+    """
+    Returns the full path of the given command, looking into $PATH only once.
+    """
+    return shutil.which(command)
+
 class Role(Enum):
     Monitor = 1
     Postgres = 2
@@ -34,9 +64,6 @@ class Cluster:
         Initializes the environment, virtual network, and other local state
         necessary for operation of the Cluster.
         """
-        os.environ["PG_REGRESS_SOCK_DIR"] = ''
-        os.environ["PG_AUTOCTL_DEBUG"] = ''
-        os.environ["PGHOST"] = 'localhost'
         self.vlan = network.VirtualLAN(networkNamePrefix, networkSubnet)
         self.monitor = None
         self.datanodes = []
@@ -68,13 +95,51 @@ class Cluster:
         self.datanodes.append(datanode)
         return datanode
 
+    def create_datanodes(self, configs):
+        """
+        Initializes several data nodes concurrently and returns the list of
+        DataNode instances. Each entry of configs is a dict of keyword
+        arguments for create_datanode(). The "pg_autoctl create" commands all
+        run at the same time, so only use this for nodes that can be created
+        independently of each other, e.g. not a primary and its secondary.
+        """
+        datanodes = [self.create_datanode(**config) for config in configs]
+        for datanode in datanodes:
+            datanode.create_start()
+        for datanode in datanodes:
+            datanode.create_finish()
+
+            # the monitor assigns node ids in registration order, which is
+            # not the order we created the nodes in anymore
+            datanode.nodeid = datanode.monitor_nodeid()
+        return datanodes
+
+    def wait_until_states(self, targets, timeout=STATE_CHANGE_TIMEOUT):
+        """
+        Waits until each data node of the targets dict reaches its target
+        state, e.g. {node1: "primary", node2: "secondary"}. Returns True when
+        they all did, False if this doesn't happen until "timeout" seconds.
+        """
+        return self.monitor.wait_until_states(targets, timeout)
+
     def destroy(self):
         """
         Cleanup whatever was created for this Cluster.
         """
+        # destroy the data nodes concurrently, they don't depend on each other:
+        # first stop all the keepers, then run all the destroy commands
+        for datanode in self.datanodes:
+            datanode.terminate_pg_autoctl()
+        deadline = time.monotonic() + COMMAND_TIMEOUT
         for datanode in self.datanodes:
-            datanode.destroy()
+            datanode.wait_pg_autoctl(max(deadline - time.monotonic(), 0))
+
+        destroy_procs = [datanode.destroy_start()
+                         for datanode in self.datanodes]
+        for datanode, destroy_proc in zip(self.datanodes, destroy_procs):
+            datanode.destroy_finish(destroy_proc)
         if self.monitor:
+            self.monitor.close_connections()
             self.monitor.destroy()
         self.vlan.destroy()
 
@@ -91,77 +156,169 @@ class PGNode:
         self.database = database
         self.role = role
         self.pg_autoctl_run_proc = None
+        self.pg_autoctl_run_log = None
+        self._run_log_started = False
         self.authenticatedUsers = {}
-            
+        self.address_str = str(vnode.address)
+        self._connection_string = None
+
+        # pg_autoctl files are located at the same relative path as PGDATA
+        # from /, under ~/.config and ~/.local/share
+        home = Path(os.getenv("HOME"))
+        pgdata = Path(os.path.abspath(self.datadir))
+        pgdata = pgdata.relative_to(pgdata.anchor)
+        self._config_path = home / ".config/pg_autoctl" / pgdata / "pg_autoctl.cfg"
+        self._state_path = home / ".local/share/pg_autoctl" / pgdata / "pg_autoctl.state"
+
 
     def connection_string(self):
         """
         Returns a connection string which can be used to connect to this postgres
-        node.
+        node. It is computed once, and again after set_user_password().
         """
+        if self._connection_string is not None:
+            return self._connection_string
+
         if (self.authMethod and self.username in self.authenticatedUsers):
-            return ("postgres://%s:%s@%s:%d/%s" % (self.username, self.authenticatedUsers[self.username], self.vnode.address,
+            self._connection_string = ("postgres://%s:%s@%s:%d/%s" % (self.username, self.authenticatedUsers[self.username], self.address_str,
                     self.port, self.database))
-        
-        return ("postgres://%s@%s:%d/%s" % (self.username, self.vnode.address,
+        else:
+            self._connection_string = ("postgres://%s@%s:%d/%s" % (self.username, self.address_str,
                                            self.port, self.database))
+        return self._connection_string
 
     def run(self, env={}):
         """
         Runs "pg_autoctl run"
+
+        Its output goes to a log file next to PGDATA: nobody reads the pipes of
+        this long-lived process, and pg_autoctl would block once they're full.
+        The log file is truncated on the first run of this node, and appended
+        to when the node is restarted.
         """
-        run_command = [shutil.which('pg_autoctl'), 'run',
+        run_command = [_which('pg_autoctl'), 'run',
                           '--pgdata', self.datadir]
-        self.pg_autoctl_run_proc = self.vnode.run(run_command)
+        self._close_run_log()
+        mode = "ab" if self._run_log_started else "wb"
+        self.pg_autoctl_run_log = open(self.run_log_path(), mode)
+        self._run_log_started = True
+        self.pg_autoctl_run_proc = self.vnode.run(run_command,
+                                                  stdout=self.pg_autoctl_run_log,
+                                                  stderr=subprocess.STDOUT)
 
-    def run_sql_query(self, query, *args):
+    def run_log_path(self):
+        """
+        Returns the path of the file where "pg_autoctl run" logs for this node.
+        """
+        return os.path.abspath(self.datadir) + ".pg_autoctl.log"
+
+    def _close_run_log(self):
+        """
+        Closes our handle on the "pg_autoctl run" log file, if any.
+        """
+        if self.pg_autoctl_run_log:
+            self.pg_autoctl_run_log.close()
+            self.pg_autoctl_run_log = None
+
+    def run_sql_query(self, query, *args, one=False):
         """
         Runs the given sql query with the given arguments in this postgres node
         and returns the results. Returns None if there are no results to fetch.
+        When one is True, only the first row is returned.
         """
         with psycopg2.connect(self.connection_string()) as conn:
-            cur = conn.cursor()
-            cur.execute(query, args)
-            try:
-                result = cur.fetchall()
-                return result
-            except psycopg2.ProgrammingError:
-                return None
+            return self._execute(conn, query, args, one)
+
+    def _execute(self, conn, query, args, one=False):
+        """
+        Runs the given sql query on the given connection and returns the
+        results, or only the first row when one is True. Returns None if there
+        are no results to fetch.
+        """
+        cur = conn.cursor()
+        cur.execute(query, args)
+        if cur.description is None:
+            return None
+        if one:
+            return cur.fetchone()
+        return cur.fetchall()
 
     def set_user_password(self, username, password):
         """
         Sets user passwords on the PGNode
         """
-        alter_user_set_passwd_command =  "alter user %s with password \'%s\'" % (username, password)
-        passwd_command = [shutil.which('psql'), '-d', self.database, '-c', alter_user_set_passwd_command]
-        passwd_proc = self.vnode.run(passwd_command)
-        wait_or_timeout_proc(passwd_proc,
-                         name="user passwd",
-                         timeout=COMMAND_TIMEOUT)
+        self.run_psql("alter user :\"username\" with password :'password'",
+                      name="user passwd",
+                      username=username, password=password)
         self.authenticatedUsers[username] = password
+        self._connection_string = None
+
+    def run_psql(self, sql, name, **variables):
+        """
+        Runs the given sql with psql from this node, as the superuser. Values
+        are given as psql variables and referenced as :'name' or :"name" in
+        the sql, so that psql quotes them properly.
+        """
+        psql_command = [_which('psql'), '-d', self.database,
+                        '-v', 'ON_ERROR_STOP=1']
+        for variable, value in variables.items():
+            psql_command += ['-v', '%s=%s' % (variable, value)]
+
+        # psql only interpolates variables in sql it reads from stdin or a file
+        psql_proc = self.vnode.run(psql_command)
+        return wait_or_timeout_proc(psql_proc,
+                                    name=name,
+                                    timeout=COMMAND_TIMEOUT,
+                                    input=sql + ";\n")
     
     def stop_pg_autoctl(self):
         """
-        Kills the keeper by sending a SIGTERM to keeper's process group.
+        Kills the keeper by sending a SIGTERM to keeper's process group, and
+        waits until it has exited so that callers don't race against the
+        keeper's shutdown.
+        """
+        self.terminate_pg_autoctl()
+        return self.wait_pg_autoctl()
+
+    def terminate_pg_autoctl(self):
+        """
+        Sends a SIGTERM to keeper's process group, without waiting for the
+        keeper to exit, see wait_pg_autoctl().
         """
         if self.pg_autoctl_run_proc:
             os.killpg(os.getpgid(self.pg_autoctl_run_proc.pid), signal.SIGTERM)
 
+    def wait_pg_autoctl(self, timeout=COMMAND_TIMEOUT):
+        """
+        Waits until the keeper terminated with terminate_pg_autoctl() has
+        exited. Returns False if it is still running after timeout seconds.
+        """
+        if self.pg_autoctl_run_proc:
+            try:
+                self.pg_autoctl_run_proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                print("pg_autoctl run for '%s' did not stop after %ds" %
+                      (self.datadir, timeout))
+                return False
+            self.pg_autoctl_run_proc = None
+            self._close_run_log()
+        return True
+
     def stop_postgres(self):
         """
         Stops the postgres process by running:
           pg_ctl -D ${self.datadir} --wait --mode immediate stop
         """
-        stop_command = [shutil.which('pg_ctl'), '-D', self.datadir,
+        stop_command = [_which('pg_ctl'), '-D', self.datadir,
                         '--wait', '--mode', 'immediate', 'stop']
         stop_proc = self.vnode.run(stop_command)
         out, err = stop_proc.communicate(timeout=COMMAND_TIMEOUT)
         if stop_proc.returncode > 0:
             print("stopping postgres for '%s' failed, out: %s\n, err: %s"
-                  %(self.vnode.address, out, err))
+                  %(self.address_str, out, err))
             return False
         elif stop_proc.returncode is None:
-            print("stopping postgres for '%s' timed out")
+            print("stopping postgres for '%s' timed out" % self.address_str)
             return False
         return True
 
@@ -169,9 +326,12 @@ class PGNode:
         """
         Returns true when Postgres is running. We use pg_ctl status.
         """
-        status_command = [shutil.which('pg_ctl'), '-D', self.datadir, 'status']
-        status_proc = self.vnode.run(status_command)
-        out, err = status_proc.communicate(timeout=timeout)
+        # we only look at the exit code and postmaster.pid, discard the output
+        status_command = [_which('pg_ctl'), '-D', self.datadir, 'status']
+        status_proc = self.vnode.run(status_command,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        status_proc.communicate(timeout=timeout)
         if status_proc.returncode == 0:
             # pg_ctl status is happy to report 0 (Postgres is running) even
             # when it's still "starting" and thus not ready for queries.
@@ -192,18 +352,24 @@ class PGNode:
 
     def wait_until_pg_is_running(self, timeout=STATE_CHANGE_TIMEOUT):
         """
-        Waits until the underlying Postgres process is running.
+        Waits until the underlying Postgres process is running. We check first,
+        then back off exponentially from 50ms up to 1s between attempts.
         """
-        for i in range(timeout):
-            time.sleep(1)
-
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
             if self.pg_is_running():
                 return True
 
-        else:
-            print("Postgres is still not running in %s after %d attempts" %
-                  (self.datadir, timeout))
-            return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+        print("Postgres is still not running in %s within %.1fs" %
+              (self.datadir, timeout))
+        return False
 
     def fail(self):
         """
@@ -218,15 +384,31 @@ class PGNode:
         Cleans up processes and files created for this data node.
         """
         self.stop_pg_autoctl()
-        destroy_command = [shutil.which('pg_autoctl'), 'do', 'destroy',
+        self.destroy_finish(self.destroy_start())
+
+    def destroy_start(self):
+        """
+        Starts "pg_autoctl do destroy" without waiting for it, so that several
+        nodes can be destroyed concurrently. The keeper must have been stopped
+        already. Returns the process to pass to destroy_finish().
+        """
+        destroy_command = [_which('pg_autoctl'), 'do', 'destroy',
                             '--pgdata', self.datadir]
-        destroy_proc = self.vnode.run(destroy_command)
+        return self.vnode.run(destroy_command)
+
+    def destroy_finish(self, destroy_proc):
+        """
+        Waits for the "pg_autoctl do destroy" process started by destroy_start()
+        and removes the files created for this node. The "pg_autoctl run" log
+        file is kept for post-mortem analysis.
+        """
         try:
             wait_or_timeout_proc(destroy_proc,
                                  name="pg_autoctl do destroy",
                                  timeout=COMMAND_TIMEOUT)
         except Exception as e:
             print(str(e))
+        self._close_run_log()
         try:
             os.remove(self.config_file_path())
         except FileNotFoundError:
@@ -243,12 +425,7 @@ class PGNode:
         """
         # Config file is located at:
         # ~/.config/pg_autoctl/${PGDATA}/pg_autoctl.cfg
-        home = os.getenv("HOME")
-        pgdata = os.path.abspath(self.datadir)[1:] # Remove the starting '/'
-        return os.path.join(home,
-                            ".config/pg_autoctl",
-                            pgdata,
-                            "pg_autoctl.cfg")
+        return self._config_path
 
     def state_file_path(self):
         """
@@ -256,12 +433,7 @@ class PGNode:
         """
         # State file is located at:
         # ~/.local/share/pg_autoctl/${PGDATA}/pg_autoctl.state
-        home = os.getenv("HOME")
-        pgdata = os.path.abspath(self.datadir)[1:] # Remove the starting '/'
-        return os.path.join(home,
-                            ".local/share/pg_autoctl",
-                            pgdata,
-                            "pg_autoctl.state")
+        return self._state_path
 
 class DataNode(PGNode):
     def __init__(self, datadir, vnode, port, username, authMethod, database, monitor,
@@ -272,78 +444,98 @@ class DataNode(PGNode):
         self.group = group
         self.listen_flag = listen_flag
         self.formation = formation
+        self._init_proc = None
 
     def create(self):
         """
         Runs "pg_autoctl create"
         """
+        self.create_start()
+        self.create_finish()
+
+    def create_start(self):
+        """
+        Starts "pg_autoctl create" without waiting for it to finish, see
+        create_finish().
+        """
         pghost = 'localhost'
 
         if self.listen_flag:
-            pghost = str(self.vnode.address)
+            pghost = self.address_str
 
         # don't pass --nodename to Postgres nodes in order to exercise the
         # automatic detection of the nodename.
-        create_command = [shutil.which('pg_autoctl'), '-vvv', 'create',
+        create_command = [_which('pg_autoctl'), '-vvv', 'create',
                           self.role.command(),
                         '--pgdata', self.datadir,
                         '--pghost', pghost,
                         '--pgport', str(self.port),
-                        '--pgctl', shutil.which('pg_ctl'),
+                        '--pgctl', _which('pg_ctl'),
                         '--monitor', self.monitor.connection_string()]
 
         if self.listen_flag:
-            create_command += ['--listen', str(self.vnode.address)]
+            create_command += ['--listen', self.address_str]
 
         if self.formation:
             create_command += ['--formation', self.formation]
 
-        init_proc = self.vnode.run(create_command)
+        self._init_proc = self.vnode.run(create_command)
+
+    def create_finish(self):
+        """
+        Waits for the "pg_autoctl create" command started by create_start().
+        """
+        init_proc, self._init_proc = self._init_proc, None
         wait_or_timeout_proc(init_proc,
                              name="keeper init",
                              timeout=COMMAND_TIMEOUT)
 
 
+    def monitor_nodeid(self):
+        """
+        Returns the node id that the monitor assigned to this node. We look it
+        up by the nodename and port registered in the node's pg_autoctl
+        configuration file, without running any pg_autoctl command.
+        """
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(str(self.config_file_path()))
+        results = self.monitor.run_sql_query(
+            """
+SELECT nodeid
+  FROM pgautofailover.node
+ WHERE nodename=%s and nodeport=%s
+""",
+            config["pg_autoctl"]["nodename"],
+            int(config["postgresql"]["port"]),
+            one=True)
+        if results is None:
+            raise Exception("datanode not found at coordinator")
+        return results[0]
+
     def wait_until_state(self, target_state, timeout=STATE_CHANGE_TIMEOUT):
         """
         Waits until this data node reaches the target state, and then returns
         True. If this doesn't happen until "timeout" seconds, returns False.
         """
-        prev_state = None
-        for i in range(timeout):
-            time.sleep(1)
-            current_state = self.get_state()
-
-            # only log the state if it has changed
-            if current_state != prev_state:
-                print("state of %s is '%s', waiting for '%s' ..." %
-                    (self.datadir, current_state, target_state))
-
-            if current_state == target_state:
-                return True
-            prev_state = current_state
-        else:
-            print("%s didn't reach %s after %d attempts" %
-                (self.datadir, target_state, timeout))
-            return False
+        return self.monitor.wait_until_states({self: target_state}, timeout)
 
     def get_state(self):
         """
         Returns the current state of the data node. This is done by querying the
         monitor node.
         """
-        results = self.monitor.run_sql_query(
+        results = self.monitor.run_prepared_query(
+            "get_state",
             """
 SELECT reportedstate
   FROM pgautofailover.node
- WHERE nodeid=%s and groupid=%s
+ WHERE nodeid=$1 and groupid=$2
 """,
-            self.nodeid, self.group)
-        if len(results) == 0:
+            self.nodeid, self.group, one=True)
+        if results is None:
             raise Exception("datanode not found at coordinator")
         else:
-            return results[0][0]
-        return results
+            return results[0]
 
     def enable_maintenance(self):
         """
@@ -351,7 +543,7 @@ SELECT reportedstate
 
         :return:
         """
-        command = [shutil.which('pg_autoctl'), 'enable', 'maintenance',
+        command = [_which('pg_autoctl'), 'enable', 'maintenance',
                    '--pgdata', self.datadir]
         proc = self.vnode.run(command)
         wait_or_timeout_proc(proc,
@@ -364,7 +556,7 @@ SELECT reportedstate
 
         :return:
         """
-        command = [shutil.which('pg_autoctl'), 'disable', 'maintenance',
+        command = [_which('pg_autoctl'), 'disable', 'maintenance',
                    '--pgdata', self.datadir]
         proc = self.vnode.run(command)
         wait_or_timeout_proc(proc,
@@ -377,7 +569,7 @@ SELECT reportedstate
 
         :return:
         """
-        drop_command = [shutil.which('pg_autoctl'), 'drop', 'node',
+        drop_command = [_which('pg_autoctl'), 'drop', 'node',
                        '--pgdata', self.datadir]
         drop_proc = self.vnode.run(drop_command)
         wait_or_timeout_proc(drop_proc, name="drop node", timeout=COMMAND_TIMEOUT)
@@ -393,14 +585,21 @@ class MonitorNode(PGNode):
         if nodename:
             self.nodename = nodename
         else:
-            self.nodename = str(self.vnode.address)
+            self.nodename = self.address_str
+
+        # connections are opened lazily and kept until close_connections()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = threading.BoundedSemaphore(MONITOR_POOL_SIZE)
+        self._prepared = {}
+        self._listen_conns = {}
 
 
     def create(self):
         """
         Initializes and runs the monitor process.
         """
-        init_command = [shutil.which('pg_autoctl'), '-vvv', 'create',
+        init_command = [_which('pg_autoctl'), '-vvv', 'create',
                         self.role.command(),
                         '--pgdata', self.datadir,
                         '--pgport', str(self.port),
@@ -426,7 +625,7 @@ class MonitorNode(PGNode):
         :param dbname: name of the database to use in the formation
         :return: None
         """
-        formation_command = [shutil.which('pg_autoctl'), 'create', 'formation',
+        formation_command = [_which('pg_autoctl'), 'create', 'formation',
                              '--pgdata', self.datadir,
                              '--formation', formation_name,
                              '--kind', kind]
@@ -455,7 +654,7 @@ class MonitorNode(PGNode):
         :param formation: name of the formation to enable the feature on
         :return: None
         """
-        enable_command = [shutil.which('pg_autoctl'), 'enable', feature.command(),
+        enable_command = [_which('pg_autoctl'), 'enable', feature.command(),
                           '--pgdata', self.datadir,
                           '--formation', formation]
 
@@ -474,7 +673,7 @@ class MonitorNode(PGNode):
         :param formation: name of the formation to disable the feature on
         :return: None
         """
-        disable_command = [shutil.which('pg_autoctl'), 'disable', feature.command(),
+        disable_command = [_which('pg_autoctl'), 'disable', feature.command(),
                           '--pgdata', self.datadir,
                           '--formation', formation]
 
@@ -487,27 +686,244 @@ class MonitorNode(PGNode):
         """
         performs manual failover for given formation and group id
         """
-        failover_commmand_text = "select * from pgautofailover.perform_failover('%s', %s)" %(formation, group)
-        failover_command = [shutil.which('psql'), '-d', self.database, '-c', failover_commmand_text]
-        failover_proc = self.vnode.run(failover_command)
-        wait_or_timeout_proc(failover_proc,
-                         name="manual failover",
-                         timeout=COMMAND_TIMEOUT)
+        self.run_psql("select * from pgautofailover.perform_failover(:'formation', :'group')",
+                      name="manual failover",
+                      formation=formation, group=group)
+
+    def run_sql_query(self, query, *args, one=False):
+        """
+        Runs the given sql query with the given arguments in the monitor and
+        returns the results, using a pooled connection rather than connecting
+        again for each query. Returns None if there are no results to fetch.
+        When one is True, only the first row is returned.
+        """
+        with self._pooled_connection() as conn:
+            return self._execute(conn, query, args, one)
+
+    def run_prepared_query(self, name, query, *args, one=False):
+        """
+        Runs the given sql query as the prepared statement "name" and returns
+        the results. The statement is prepared once per pooled connection, so
+        that polling queries aren't parsed and planned again each time. The
+        query refers to its arguments as $1, $2, etc. When one is True, only
+        the first row is returned.
+        """
+        with self._pooled_connection() as conn:
+            prepared = self._prepared.setdefault(conn, set())
+            if name not in prepared:
+                conn.cursor().execute("PREPARE %s AS %s" % (name, query))
+                prepared.add(name)
+
+            if args:
+                execute = "EXECUTE %s(%s)" % (name, ", ".join(["%s"] * len(args)))
+            else:
+                execute = "EXECUTE %s" % name
+            return self._execute(conn, execute, args, one)
+
+    @contextlib.contextmanager
+    def _pooled_connection(self):
+        """
+        Provides a connection from the monitor's pool within a transaction, and
+        gives it back to the pool afterwards. psycopg2 pools raise PoolError
+        rather than block when all their connections are in use, so we wait
+        for a free slot first.
+        """
+        with self._pool_slots:
+            with self._pool_lock:
+                if self._pool is None:
+                    # minconn is maxconn so that the pool keeps all of its
+                    # connections open rather than closing them when returned
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        MONITOR_POOL_SIZE, MONITOR_POOL_SIZE,
+                        self.connection_string())
+                pool = self._pool
+
+            conn = pool.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+
+                # the pool may also close connections, forget their statements
+                if conn.closed:
+                    self._prepared.pop(conn, None)
+
+    def set_user_password(self, username, password):
+        """
+        Sets user passwords on the monitor, and drops connections that have
+        been opened with the previous credentials.
+        """
+        super().set_user_password(username, password)
+        self.close_connections()
 
+    def get_states(self, nodeids):
+        """
+        Returns the current state of the given data nodes as a dict from node
+        id to state, using a single query.
+        """
+        results = self.run_prepared_query(
+            "get_states",
+            """
+SELECT nodeid, reportedstate
+  FROM pgautofailover.node
+ WHERE nodeid = ANY($1)
+""",
+            list(nodeids))
+        return dict(results)
+
+    def wait_until_states(self, targets, timeout=STATE_CHANGE_TIMEOUT):
+        """
+        Waits until each data node of the targets dict reaches its target
+        state, and then returns True. If this doesn't happen until "timeout"
+        seconds, returns False.
+
+        Rather than polling, we LISTEN to the monitor's state channel and only
+        check the states again, with a single query, when the monitor notifies
+        a change for one of the nodes we are still waiting for.
+        """
+        deadline = time.monotonic() + timeout
+        waiting = {datanode.nodeid: (datanode, target_state)
+                   for datanode, target_state in targets.items()}
+        prev_states = {}
+        conn = self.listen(STATE_CHANNEL)
+        while True:
+            states = self.get_states(waiting.keys())
+
+            for nodeid, (datanode, target_state) in list(waiting.items()):
+                if nodeid not in states:
+                    raise Exception("datanode not found at coordinator")
+                current_state = states[nodeid]
+
+                # only log the state if it has changed
+                if current_state != prev_states.get(nodeid):
+                    print("state of %s is '%s', waiting for '%s' ..." %
+                        (datanode.datadir, current_state, target_state))
+
+                if current_state == target_state:
+                    del waiting[nodeid]
+                prev_states[nodeid] = current_state
+
+            if not waiting:
+                return True
 
+            # sleep until the monitor notifies a change for a node we wait for
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    for datanode, target_state in waiting.values():
+                        print("%s didn't reach %s within %.1fs" %
+                            (datanode.datadir, target_state, timeout))
+                    return False
+                payloads = wait_for_notifications(conn, remaining)
+                if any(state_notification_nodeid(payload) in waiting
+                       for payload in payloads):
+                    break
+
+    def listen(self, channel):
+        """
+        Returns a connection to the monitor that LISTENs on the given
+        notification channel. The connection is kept open and shared by the
+        callers of the same thread, notifications received before this call
+        are discarded.
+        """
+        # each thread gets its own connection, so that concurrent waiters
+        # don't consume each other's notifications
+        key = (channel, threading.get_ident())
+        conn = self._listen_conns.get(key)
+        if conn is not None and not conn.closed:
+            try:
+                conn.poll()
+                del conn.notifies[:]
+                return conn
+            except psycopg2.OperationalError:
+                conn.close()
 
-def wait_or_timeout_proc(proc, name, timeout):
+        conn = psycopg2.connect(self.connection_string())
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute("LISTEN %s" % channel)
+        self._listen_conns[key] = conn
+        return conn
+
+    def close_connections(self):
+        """
+        Closes the connections opened to the monitor by this process.
+        """
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+            self._prepared = {}
+        for conn in self._listen_conns.values():
+            conn.close()
+        self._listen_conns = {}
+
+
+def run_concurrently(*calls):
+    """
+    Runs the given callables at the same time, each in its own thread, and
+    returns their results in the same order. This allows a test to overlap
+    independent operations, e.g.:
+
+      run_concurrently(lambda: node1.enable_maintenance(),
+                       lambda: node2.wait_until_state("primary"))
+
+    If a call raises an exception, it is raised again here once all the calls
+    are done.
+    """
+    if not calls:
+        raise ValueError("run_concurrently needs at least one call")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+
+def wait_or_timeout_proc(proc, name, timeout, input=None):
     """
     Waits for command to exit successfully. If it exits with error or it timeouts,
-    raises an execption with stdout and stderr streams of the process.
+    raises an execption with stdout and stderr streams of the process. When
+    given, input is sent to the command's stdin.
     """
     try:
-        out, err = proc.communicate(timeout=COMMAND_TIMEOUT)
+        # proc is an NSPopen proxy: the pipes belong to the helper process in
+        # the node's namespace, where communicate() runs a selectors loop
+        out, err = proc.communicate(input=input, timeout=timeout)
         if proc.returncode > 0:
             raise Exception("%s failed, out: %s\n, err: %s" % (name, out, err))
         return out, err
     except subprocess.TimeoutExpired:
-        proc.kill()
+        # proc is sudo, kill its whole session so that the command itself and
+        # its children don't survive it
+        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
         out, err = proc.communicate()
         raise Exception("%s timed out after %d seconds. out: %s\n, err: %s" \
                         % (name, timeout, out, err))
+
+
+def wait_for_notifications(conn, timeout):
+    """
+    Waits until a notification arrives on the given LISTENing connection or
+    timeout seconds have passed, and returns the payloads received so far.
+    """
+    if not conn.notifies:
+        select.select([conn], [], [], timeout)
+        conn.poll()
+    payloads = [notify.payload for notify in conn.notifies]
+    del conn.notifies[:]
+    return payloads
+
+
+def state_notification_nodeid(payload):
+    """
+    Returns the node id from a monitor state change notification. The payload
+    is formatted as follows, where strings are prefixed with their length:
+
+      S:reportedstate:goalstate:len.formation:groupid:nodeid:len.nodename:port
+    """
+    _, _, _, rest = payload.split(':', 3)
+    length, rest = rest.split('.', 1)
+    # skip the formation and the colon that follows it
+    rest = rest[int(length) + 1:]
+    _, nodeid, _ = rest.split(':', 2)
+    return int(nodeid)
@@ -50,7 +50,11 @@ def test_005_writes_to_node2_fail():
     node2.run_sql_query("INSERT INTO t1 VALUES (3)")
 
 def test_006_maintenance():
-    node2.enable_maintenance()
+    # the primary goes to wait_primary while its secondary enters maintenance
+    results = pgautofailover.run_concurrently(
+        node2.enable_maintenance,
+        lambda: node1.wait_until_state(target_state="wait_primary"))
+    assert results[1]
     assert node2.wait_until_state(target_state="maintenance")
     node2.stop_postgres()
     node1.run_sql_query("INSERT INTO t1 VALUES (3)")
@@ -104,16 +108,14 @@ def test_014_add_new_secondary():
 
 def test_015_multiple_manual_failover_verify_replication_slot_removed():
    monitor.failover()
-   assert node3.wait_until_state(target_state="primary")
-   assert node2.wait_until_state(target_state="secondary")
+   assert cluster.wait_until_states({node3: "primary", node2: "secondary"})
    node2_replication_slots = node2.run_sql_query("select count(*) from pg_replication_slots")
    assert node2_replication_slots == [(0,)]
    node3_replication_slots = node3.run_sql_query("select count(*) from pg_replication_slots")
    assert node3_replication_slots == [(1,)]
    
    monitor.failover()
-   assert node2.wait_until_state(target_state="primary")
-   assert node3.wait_until_state(target_state="secondary")
+   assert cluster.wait_until_states({node2: "primary", node3: "secondary"})
    node2_replication_slots = node2.run_sql_query("select count(*) from pg_replication_slots");
    assert node2_replication_slots == [(1,)]
    node3_replication_slots = node3.run_sql_query("select count(*) from pg_replication_slots");
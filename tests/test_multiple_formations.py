@@ -0,0 +1,41 @@
+import pgautofailover_utils as pgautofailover
+from nose.tools import *
+
+cluster = None
+monitor = None
+node1 = None
+node2 = None
+
+def setup_module():
+    global cluster
+    cluster = pgautofailover.Cluster()
+
+def teardown_module():
+    cluster.destroy()
+
+def test_000_create_monitor():
+    global monitor
+    monitor = cluster.create_monitor("/tmp/formations/monitor")
+
+def test_001_create_formations():
+    monitor.create_formation("formation1")
+    monitor.create_formation("formation2")
+
+def test_002_init_primaries_concurrently():
+    global node1, node2
+    node1, node2 = cluster.create_datanodes([
+        {"datadir": "/tmp/formations/node1", "formation": "formation1"},
+        {"datadir": "/tmp/formations/node2", "formation": "formation2"}])
+    node1.run()
+    node2.run()
+    assert cluster.wait_until_states({node1: "single", node2: "single"})
+
+def test_003_node_ids_match_formations():
+    results = monitor.run_sql_query(
+        "SELECT formationid FROM pgautofailover.node WHERE nodeid = %s",
+        node1.nodeid)
+    assert results == [("formation1",)]
+    results = monitor.run_sql_query(
+        "SELECT formationid FROM pgautofailover.node WHERE nodeid = %s",
+        node2.nodeid)
+    assert results == [("formation2",)]